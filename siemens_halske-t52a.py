@@ -19,9 +19,11 @@
 # Siemens & Halske SFM T52a Cipher Machine simulator
 #
 
+import ast
 import sys
 import textwrap
 import argparse
+import re
 from pathlib import Path
 import random
 randgen = random.SystemRandom()
@@ -46,7 +48,7 @@ MSK7   = 127    # mask off 7 LSBs
 #
 # Dollor  $  represents "WHO ARE YOU" 
 # Tilda  (~) represents "Bell"
-asc2tty = [ 
+asc2tty = bytes([
 # NUL                                       \a
   64, INVC, INVC, INVC, INVC, INVC, INVC,  154, INVC, INVC,
 # \n                \r
@@ -67,7 +69,19 @@ INVC, 158, 143, 137, 147,INVC, 24, 19, 14, 18, 16, 22, 11,
 # d   e   f   g  h   i   j   k  l  m  n   o  p   q   r   s
  18, 16, 22, 11, 5, 12, 26, 30, 9, 7, 6, 3, 13, 29, 10, 20,
 # t   u   v   w   x   y   z    {     |    }    ~   DEL
-  1, 28, 15, 25, 23, 21, 17, 158, INVC, 137, 154, INVC]
+  1, 28, 15, 25, 23, 21, 17, 158, INVC, 137, 154, INVC])
+
+# asc2tty repeated for bytes with the MSB set, for use with bytes.translate()
+asc2tty_full = asc2tty * 2
+asc2tty_invalid = bytes([i for i in range(256) if asc2tty_full[i] == INVC])
+
+# Converted codes keep their flags, so letters lie in 0-31, either shift
+# in 64-95 and figures in 128-159. Matches a run of chars that needs the
+# figures shift, up to the next char that needs letters shift.
+figs_run_re = re.compile(rb'([\x80-\x9f][\x40-\x5f\x80-\x9f]*)')
+
+# For masking every byte to its 5 LSBs with bytes.translate()
+msk5_table = bytes([i & MSK5 for i in range(256)])
 
 # For converting 5-bits TTY code to ASCII.
 tty_ltrs2asc = [
@@ -82,21 +96,30 @@ tty_figs2asc = [
        '3', '+',    '$',  '?', "'", '6', '&', '/',
        '-', '2', '\x07', FIGS, '7', '1', '(', LTRS]
 
+# The tables above for all byte values, ignoring the 3 MSBs, for use with
+# bytes.translate(). Shift chars are split out before translating.
+tty_ltrs2asc_full = bytes([ord(c) if isinstance(c, str) else c
+                           for c in tty_ltrs2asc] * 8)
+tty_figs2asc_full = bytes([ord(c) if isinstance(c, str) else c
+                           for c in tty_figs2asc] * 8)
+
+# Matches a shift char in 5-bits TTY code.
+tty_shift_re = re.compile(rb'([\x1b\x1f])')
+
 tty2bpname = [
     '/', 'T', '3', 'O', '9', 'H', 'N', 'M',
     '4', 'L', 'R', 'G', 'I', 'P', 'C', 'V',
     'E', 'Z', 'D', 'B', 'S', 'Y', 'F', 'X',
     'A', 'W', 'J', '5', 'U', 'Q', 'K', '8']
 
+# tty2bpname for all byte values, ignoring the 3 MSBs, for bytes.translate()
+tty2bpname_full = ''.join(tty2bpname * 8).encode('ascii')
+
 def tty2blyprintout(s):
-    
-    result = []
-    for char in s:
-        char = ord(char) & MSK5
-        char = tty2bpname[char]
-        result.append(char)
+    '''Convert from 5-bits TTY code to Bletchley Park teleprinter
+    format. Takes and returns bytes.'''
 
-    return ''.join(result)
+    return s.translate(tty2bpname_full)
 
 
 def ascii2tty(s):
@@ -104,76 +127,81 @@ def ascii2tty(s):
 
     Assumes reader may initially be in either letters or figures
     shift, and emits a shift char prior to first output char that
-    is not valid in either shift.'''
-
-    figs = False
-    result = []
-    # Emit initial shift if needed
-    if len(s) > 0:
-        char = asc2tty[s[0] & MSK7]
-        if (char & ETHR_F):
-            # Valid in either shift
-            pass
-        elif (char & FIGS_F):
-            # Must be in figures shift
-            result.append(chr(FIGS))
-            figs = True
-        else:
-            # Must be in letters shift
-            result.append(chr(LTRS))
-            figs = False
-    
-    # Convert chars
-    for char in s:
-        # Drop MSB and convert
-        char = asc2tty[char & MSK7]
-
-        # Convert if valid
-        if char != INVC:
-
-            # Emit shift char if needed
-            if (char & ETHR_F):
-                # Valid in either shift
-                pass
-            elif (char & FIGS_F):
-                # Must be in figures shift
-                if figs is not True:
-                    # Not already in figures shift
-                    # i.e. either in letters shift or indeterminate
-                    result.append(chr(FIGS))
-                    figs = True
-            elif figs is not False:
-                # In figures or indeterminate shift, but must be in letter shift
-                result.append(chr(LTRS))
-                figs = False
-
-            # Emit the converted char
-            result.append(chr(char & MSK5))
-
-    return ''.join(result)
+    is not valid in either shift. Takes and returns bytes.'''
+
+    # Drop MSB, convert and remove invalid chars all at once
+    codes = s.translate(asc2tty_full, asc2tty_invalid)
+
+    # Emit shift chars where needed. Splitting on the figures runs gives
+    # letters and figures runs in turn, starting and ending with a letters
+    # run. Every figures run is preceded by FIGS and followed by LTRS,
+    # unless it ends the message.
+    parts = figs_run_re.split(codes)
+    runs = [f + bytes([LTRS]) + l for f, l in zip(parts[1::2], parts[2::2])]
+    codes = bytes([FIGS]).join([parts[0]] + runs)
+    if len(parts) > 1 and not parts[-1]:
+        codes = codes[:-1]
+
+    # Emit initial shift if the first char must be in letters shift.
+    # A leading figures char already got its shift above.
+    if len(s) > 0 and not (asc2tty_full[s[0]] & (ETHR_F | FIGS_F)):
+        codes = bytes([LTRS]) + codes
+
+    return codes.translate(msk5_table)
 
 
 def tty2ascii(s):
     '''Convert from 5-level TTY code to ASCII.
 
-    Assumes initial letters shift state.'''
+    Assumes initial letters shift state. Takes and returns bytes.'''
 
-    figs = False
-    result = []
-    for char in s:
-        char = ord(char) & MSK5
-        if char == LTRS:
-            figs = False
-        elif char == FIGS:
-            figs = True
+    # Drop 3 MSBs and split into runs, keeping the shift char in front
+    # of each run after the first
+    parts = tty_shift_re.split(s.translate(msk5_table))
+
+    result = [parts[0].translate(tty_ltrs2asc_full)]
+    for shift, run in zip(parts[1::2], parts[2::2]):
+        if shift[0] == FIGS:
+            result.append(run.translate(tty_figs2asc_full))
         else:
-            if figs:
-                char = tty_figs2asc[char]
-            else:
-                char = tty_ltrs2asc[char]
-            result.append(char)
+            result.append(run.translate(tty_ltrs2asc_full))
+
+    return b''.join(result)
+
+
+# Bit pairs exchanged by the swap stages, indexed by the S wheel bit that
+# enables them. Bit 4 is the leftmost bit of the code.
+SWAP_BITS = ((4, 3), (3, 2), (2, 1), (1, 0), (4, 0))
+
+# Order in which encryption applies the swap stages, by S wheel bit.
+# Decryption applies them in reverse.
+SWAP_ORDER = (4, 3, 2, 1, 0)
+
+
+def swap_packed(v, sel, ones, stages):
+    '''Apply swap stages to a whole message at once.
+
+    The message codes are packed one per byte into integer v and the S
+    wheel values into sel in the same way. ones has the lowest bit of
+    every byte set. stages lists the S wheel bits in the order their
+    stages are applied.'''
+
+    for k in stages:
+        i, j = SWAP_BITS[k]
+        # Bit 0 of each byte of d is set where the stage is enabled for
+        # that character and its two bits differ.
+        d = ((v >> i) ^ (v >> j)) & (sel >> k) & ones
+        v ^= (d << i) | (d << j)
+
+    return v
+
 
-    return ''.join(result)
+# The swap stages for every S wheel value and 5-bit code, indexed by
+# (s << 5) | v.
+swap_table = bytes([swap_packed(v, s, 1, SWAP_ORDER)
+                    for s in range(32) for v in range(32)])
+unswap_table = bytes([swap_packed(v, s, 1, SWAP_ORDER[::-1])
+                      for s in range(32) for v in range(32)])
 
 
 class Wheel:
@@ -184,8 +212,11 @@ class Wheel:
         self.wheel_size = len(wheel_data)
         self.state = initial
 
-    def advance(self):
-        self.state = (self.state + 1) % self.wheel_size
+    def advance(self, steps=1):
+        s = self.state + steps
+        if s >= self.wheel_size:
+            s %= self.wheel_size
+        self.state = s
 
     def get_val(self):
         return self.wheel_data[self.state]
@@ -195,22 +226,68 @@ class WheelBank:
     """ Class for a bank of wheels. """
 
     def __init__(self, wheels):
-        self.wheels = wheels
-
-    def advance(self):
-        for w in self.wheels:
-            w.advance()
+        # Wheel patterns, sizes and positions are kept in parallel lists
+        # so stepping the bank does not go through each Wheel object.
+        self.pats = [bytes(w.wheel_data) for w in wheels]
+        self.sizes = [w.wheel_size for w in wheels]
+        # Indicators may be edited by hand, so bring them into range
+        self.states = [w.state % w.wheel_size for w in wheels]
+
+    def advance(self, steps=1):
+        states = []
+        for s, size in zip(self.states, self.sizes):
+            s += steps
+            if s >= size:
+                s %= size
+            states.append(s)
+        self.states = states
 
     def get_val(self):
-        result = []
-        for i in range(5):
-            result.append(self.wheels[i].get_val())
-        # Wheel numbered 1 is low bit, so we need to flip the bit order.
+        """ Returns the bank value without advancing the wheels. Kept as
+            public API; the cipher itself uses step().
+        """
+        p = self.pats
+        st = self.states
+        # Wheel numbered 1 is low bit, so wheel i supplies bit i.
         # NOTE: I'm not 100% sure which wheel has the MSB and which the
         # LSB. Would be nice to confirm this better. Diagrams seem to show
         # wheel X1, for example, on input 1. And a Baudot code chart nearby
         # shows bit #1 as LSB. So I think this is right...
-        return int("0b" + ''.join([str(i) for i in result[::-1]]), 2)
+        return (p[0][st[0]] | (p[1][st[1]] << 1) |
+                (p[2][st[2]] << 2) | (p[3][st[3]] << 3) |
+                (p[4][st[4]] << 4))
+
+    def step(self):
+        """ Returns the bank value, then advances the wheels by one. """
+        p = self.pats
+        z = self.sizes
+        s0, s1, s2, s3, s4 = self.states
+        val = (p[0][s0] | (p[1][s1] << 1) | (p[2][s2] << 2) |
+               (p[3][s3] << 3) | (p[4][s4] << 4))
+        # Wrap each wheel with a compare rather than a modulo
+        s0 += 1
+        s1 += 1
+        s2 += 1
+        s3 += 1
+        s4 += 1
+        self.states = [s0 if s0 < z[0] else 0, s1 if s1 < z[1] else 0,
+                       s2 if s2 < z[2] else 0, s3 if s3 < z[3] else 0,
+                       s4 if s4 < z[4] else 0]
+        return val
+
+    def packed_stream(self, n):
+        """ Returns the bank values of the next n positions packed one per
+            byte into a big-endian int, without advancing the wheels.
+        """
+        # Each byte of a wheel stream is 0 or 1, so shifting the whole
+        # stream left by i moves every value to bit i of its own byte.
+        result = 0
+        for i, (pat, size, state) in enumerate(zip(self.pats, self.sizes,
+                                                   self.states)):
+            data = pat[state:] + pat[:state]
+            data = (data * (n // size + 1))[:n]
+            result |= int.from_bytes(data, 'big') << i
+        return result
 
 
 class SFM_T52a:
@@ -222,67 +299,68 @@ class SFM_T52a:
         self.S_wheels = WheelBank([Wheel(data, i)
                                    for data, i in zip(S, initial[5:])])
 
-    def advance(self):
-        """ Advances the wheels. Should be called after every encrypt or
-            decrypt.
+    def advance(self, steps=1):
+        """ Advances the wheels. The encrypt and decrypt methods do this
+            for every character they process.
         """
         # All wheel advance every time
-        self.X_wheels.advance()
-        self.S_wheels.advance()
+        self.X_wheels.advance(steps)
+        self.S_wheels.advance(steps)
 
     def encrypt_char(self, c):
-        """ Encrypt a single character. Expects an ordinal of the
-            character.
+        """ Encrypt a single character. Expects a 5-bit code, higher
+            bits are ignored.
         """
 
-        result = '{:05b}'.format(c ^ self.X_wheels.get_val())
-
-        # Swap operation
-        if (self.S_wheels.get_val()>>4)&1:
-            result = result[4:] + result[1:4] + result[:1]
-        if (self.S_wheels.get_val()>>3)&1:
-            result = result[:3] + result[3:5][::-1]
-        if (self.S_wheels.get_val()>>2)&1:
-            result = result[:2] + result[2:4][::-1] + result[4:]
-        if (self.S_wheels.get_val()>>1)&1:
-            result = result[:1] + result[1:3][::-1] + result[3:]
-        if self.S_wheels.get_val()&1:
-            result = result[:2][::-1] + result[2:]
+        x = self.X_wheels.step()
+        s = self.S_wheels.step()
 
-        self.advance()
-        return int(result, 2)
+        return swap_table[(s << 5) | ((c ^ x) & MSK5)]
 
     def decrypt_char(self, c):
-        """ Decrypt a single character. Expects an ordinal of the
-            character.
+        """ Decrypt a single character. Expects a 5-bit code, higher
+            bits are ignored.
         """
 
-        # Reverse swap operation
-        result = '{:05b}'.format(c)
-        if self.S_wheels.get_val()&1:
-            result = result[:2][::-1] + result[2:]
-        if (self.S_wheels.get_val()>>1)&1:
-            result = result[:1] + result[1:3][::-1] + result[3:]
-        if (self.S_wheels.get_val()>>2)&1:
-            result = result[:2] + result[2:4][::-1] + result[4:]
-        if (self.S_wheels.get_val()>>3)&1:
-            result = result[:3] + result[3:5][::-1]
-        if (self.S_wheels.get_val()>>4)&1:
-            result = result[4:] + result[1:4] + result[:1]
-
-        result = int(result, 2) ^ self.X_wheels.get_val()
-        self.advance()
-        return result
+        x = self.X_wheels.step()
+        s = self.S_wheels.step()
+
+        return unswap_table[(s << 5) | (c & MSK5)] ^ x
 
     def encrypt(self, m):
-        """ Encrypt/decrypt a message string. Uses Baudot encoding. """
+        """ Encrypt a message. Expects bytes of Baudot codes, only the
+            5 LSBs of each byte are used.
+        """
+
+        m = m.translate(msk5_table)
+        n = len(m)
+        ones = int.from_bytes(b'\x01' * n, 'big')
+
+        # XOR the whole message with the X stream at once, then swap
+        v = int.from_bytes(m, 'big') ^ self.X_wheels.packed_stream(n)
+        v = swap_packed(v, self.S_wheels.packed_stream(n), ones,
+                        SWAP_ORDER)
 
-        return ''.join([chr(self.encrypt_char(ord(c))) for c in m])
+        self.advance(n)
+        return v.to_bytes(n, 'big')
 
     def decrypt(self, m):
-        """ Encrypt/decrypt a message string. Uses Baudot encoding. """
+        """ Decrypt a message. Expects bytes of Baudot codes, only the
+            5 LSBs of each byte are used.
+        """
+
+        m = m.translate(msk5_table)
+        n = len(m)
+        ones = int.from_bytes(b'\x01' * n, 'big')
+
+        # Undo the swaps on the whole message at once, then XOR
+        v = swap_packed(int.from_bytes(m, 'big'),
+                        self.S_wheels.packed_stream(n), ones,
+                        SWAP_ORDER[::-1])
+        v ^= self.X_wheels.packed_stream(n)
 
-        return ''.join([chr(self.decrypt_char(ord(c))) for c in m])
+        self.advance(n)
+        return v.to_bytes(n, 'big')
 
 
 def write_keyfile(output_file, X_sizes, S_sizes,
@@ -301,6 +379,31 @@ def write_keyfile(output_file, X_sizes, S_sizes,
         f_out.write("indicator = %s\n\n" % str(indicator))
 
 
+def load_keyfile(key_file):
+    '''Read the settings assigned in a key file into a dict.
+
+    Only literal values are accepted, the file is never executed. The
+    file must set X_wheels, S_wheels and indicator.'''
+
+    with open(key_file, 'r') as f_in:
+        contents = f_in.read()
+
+    settings = {}
+    try:
+        for node in ast.parse(contents, str(key_file)).body:
+            if not (isinstance(node, ast.Assign) and len(node.targets) == 1
+                    and isinstance(node.targets[0], ast.Name)):
+                raise ValueError
+            settings[node.targets[0].id] = ast.literal_eval(node.value)
+        for name in ('X_wheels', 'S_wheels', 'indicator'):
+            if name not in settings:
+                raise ValueError
+    except (SyntaxError, ValueError, TypeError):
+        sys.exit('"{}" is not a valid key file.'.format(key_file))
+
+    return settings
+
+
 class gather_args(argparse.Action):
     def __call__(self, parser, namespace, values, option_string=None):
         if not 'arg_sequence' in namespace:
@@ -378,26 +481,28 @@ if __name__ == '__main__':
         S_sizes = []
         Wheel_Size = [73, 71, 69, 67, 65, 64, 61, 59, 53, 47]
         randgen.shuffle(Wheel_Size)
-        randgen.shuffle(Wheel_Size)
-        randgen.shuffle(Wheel_Size)
         for i in range(5):
             X_sizes.append(Wheel_Size.pop())
             S_sizes.append(Wheel_Size.pop())
 
-        keygen_randombuf = '{:0700b}'.format(randgen.getrandbits(700))
+        # Random bits are taken from the low end of the buffer, which is
+        # shifted down past them.
+        keygen_randombuf = randgen.getrandbits(700)
         X_wheels = [[], [], [], [], []]
         S_wheels = [[], [], [], [], []]
         indicator = [0, 0, 0, 0, 0, 0, 0, 0, 0, 0,]
         for i in range(5):
-            X_wheels[i] = list(map(int, list(keygen_randombuf[:X_sizes[i]])))
-            keygen_randombuf = keygen_randombuf[X_sizes[i]:]
-            indicator[i] = int(keygen_randombuf[:7], 2) % X_sizes[i]
-            keygen_randombuf = keygen_randombuf[7:]
+            X_wheels[i] = [(keygen_randombuf >> j) & 1
+                           for j in range(X_sizes[i])]
+            keygen_randombuf >>= X_sizes[i]
+            indicator[i] = (keygen_randombuf & MSK7) % X_sizes[i]
+            keygen_randombuf >>= 7
         for i in range(5):
-            S_wheels[i] = list(map(int, list(keygen_randombuf[:S_sizes[i]])))
-            keygen_randombuf = keygen_randombuf[S_sizes[i]:]
-            indicator[i + 5] = int(keygen_randombuf[:7], 2) % S_sizes[i]
-            keygen_randombuf = keygen_randombuf[7:]
+            S_wheels[i] = [(keygen_randombuf >> j) & 1
+                           for j in range(S_sizes[i])]
+            keygen_randombuf >>= S_sizes[i]
+            indicator[i + 5] = (keygen_randombuf & MSK7) % S_sizes[i]
+            keygen_randombuf >>= 7
         write_keyfile(key_file, X_sizes, S_sizes, X_wheels, S_wheels, indicator)
         print("New key data written to:", key_file)
 
@@ -408,12 +513,12 @@ if __name__ == '__main__':
         output_file = opt[2]
         validate_args(input_file)
         validate_args(key_file)
-        with key_file.open('r') as key_file_contents:
-            exec(key_file_contents.read())
-        input_ascii = []
+        key = load_keyfile(key_file)
+        X_wheels = key['X_wheels']
+        S_wheels = key['S_wheels']
+        indicator = key['indicator']
         with input_file.open('rb') as f_input:
-            while f_input.peek():
-                input_ascii.append(ord(f_input.read(1)))
+            input_ascii = f_input.read()
 
         input_baudot = ascii2tty(input_ascii)
 
@@ -422,7 +527,7 @@ if __name__ == '__main__':
 
         ciphertext = cipher.encrypt(input_baudot)
 
-        with open(output_file, 'w') as f_out:
+        with open(output_file, 'wb') as f_out:
             f_out.write(ciphertext)
         print("Encrypted message written to:", output_file)
 
@@ -433,12 +538,12 @@ if __name__ == '__main__':
         output_file = opt[2]
         validate_args(input_file)
         validate_args(key_file)
-        with open(key_file, 'r') as key_file_contents:
-            exec(key_file_contents.read())
-        input_ciphertext = []
+        key = load_keyfile(key_file)
+        X_wheels = key['X_wheels']
+        S_wheels = key['S_wheels']
+        indicator = key['indicator']
         with input_file.open('rb') as f:
-            while f.peek():
-                input_ciphertext.append(f.read(1))
+            input_ciphertext = f.read()
 
         print("Decrypting...")
 
@@ -448,7 +553,7 @@ if __name__ == '__main__':
 
         plaintext_ascii = tty2ascii(plaintext_stream)
 
-        with open(output_file, 'w') as f_out:
+        with open(output_file, 'wb') as f_out:
             f_out.write(plaintext_ascii)
         print("Decrypted message written to:", output_file)
 
@@ -457,23 +562,23 @@ if __name__ == '__main__':
         tty_file = Path(opt[0])
         validate_args(tty_file)
         print("Reading TTY tape file...")
-        with open(tty_file, 'r') as f_in:
+        with open(tty_file, 'rb') as f_in:
             tty_stream = f_in.read()
-        print(tty2ascii(tty_stream))
+        print(tty2ascii(tty_stream).decode('ascii'))
 
     elif cmd == 'printout':
         baudot_file = Path(opt[0])
         output_file = opt[1]
         validate_args(baudot_file)
         print("Reading TTY tape file...")
-        with open(baudot_file, 'r') as f_in:
+        with open(baudot_file, 'rb') as f_in:
             bcode = f_in.read()
         bp_print_out = tty2blyprintout(bcode)
 
-        with open(output_file, 'w') as f_out:
+        with open(output_file, 'wb') as f_out:
             f_out.write(bp_print_out)
         print("Tape in bletchley park format written to:", output_file)
-        print("The tape read:", bp_print_out)
+        print("The tape read:", bp_print_out.decode('ascii'))
 
 
     else: